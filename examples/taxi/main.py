@@ -26,10 +26,14 @@
 # TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import io
 import os
 import re
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import parsable
-from loom.util import mkdir_p, rm_rf, parallel_map
+from loom.util import mkdir_p, rm_rf
 import loom.datasets
 import loom.tasks
 
@@ -39,20 +43,55 @@ ROOT = os.path.dirname(os.path.abspath(__file__))
 SCHEMA = os.path.join(ROOT, 'schema.json')
 EXAMPLE = os.path.join(ROOT, 'example.csv')
 ROWS_CSV = os.path.join(ROOT, 'rows_csv')
+ROWS_RAW = os.path.join(ROOT, 'rows_raw')
+
+S3_MAX_CONNECTIONS = 64
+S3_CHUNK_SIZE = 8 * 1024 * 1024
+S3_MAX_CONCURRENCY = 16
+S3_MAX_WORKERS = S3_MAX_CONNECTIONS // S3_MAX_CONCURRENCY
+GUNZIP_BUFFER_SIZE = 1 << 17
+COPY_BUFFER_SIZE = 1 << 20
+
+_s3_client = None
+
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        import botocore.config
+        config = botocore.config.Config(
+            max_pool_connections=S3_MAX_CONNECTIONS)
+        _s3_client = boto3.client('s3', config=config)
+    return _s3_client
+
+
+S3_URL_RE = re.compile(r's3://([^/]*)/(.*)')
 
 
 def s3_split(url):
-    bucket, path = re.match(r's3://([^/]*)/(.*)', S3_URL).group(1, 2)
+    bucket, path = S3_URL_RE.match(url).group(1, 2)
     return bucket, path
 
 
+PARTITION_RE = re.compile(r'.*\d\d\d\.csv\.gz$', re.ASCII)
+
+
+def is_partition(key):
+    'whether key names a partition like .../123.csv.gz'
+    return PARTITION_RE.match(key) is not None
+
+
 def s3_get(bucket, source, destin):
-    import boto
+    from boto3.s3.transfer import TransferConfig
+    config = TransferConfig(
+        multipart_threshold=S3_CHUNK_SIZE,
+        multipart_chunksize=S3_CHUNK_SIZE,
+        max_concurrency=S3_MAX_CONCURRENCY,
+        use_threads=True)
     try:
         print('starting {}'.format(source))
-        conn = boto.connect_s3().get_bucket(bucket)
-        key = conn.get_key(source)
-        key.get_contents_to_filename(destin)
+        get_s3_client().download_file(bucket, source, destin, Config=config)
         print('finished {}'.format(source))
     except:
         rm_rf(destin)
@@ -64,35 +103,90 @@ def download(s3_url=S3_URL):
     '''
     Download dataset from S3 and load into loom.benchmark jig.
     '''
-    import boto
     bucket, path = s3_split(s3_url)
-    conn = boto.connect_s3().get_bucket(bucket)
-    keys = [
-        key.name
-        for key in conn.list(path)
-        if re.match(r'.*\d\d\d\.csv\.gz$', key.name)
-    ]
-    assert keys, 'nothing to download'
-    files = [os.path.join(ROWS_CSV, os.path.basename(key)) for key in keys]
-    tasks = [
-        (bucket, source, destin)
-        for source, destin in zip(keys, files)
-        if not os.path.exists(destin)
-    ]
-    if tasks:
-        print('starting download of {} files'.format(len(tasks)))
-        mkdir_p(ROWS_CSV)
-        parallel_map(s3_get, tasks)
-        print('finished download of {} files'.format(len(keys)))
+    mkdir_p(ROWS_CSV)
+    existing = set(os.listdir(ROWS_CSV))
+    counts = {'keys': 0, 'tasks': 0}
+
+    def iter_tasks():
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=path):
+            for obj in page.get('Contents', []):
+                source = obj['Key']
+                if not is_partition(source):
+                    continue
+                counts['keys'] += 1
+                filename = os.path.basename(source)
+                if filename not in existing:
+                    counts['tasks'] += 1
+                    yield bucket, source, os.path.join(ROWS_CSV, filename)
+
+    # downloads start while the bucket listing is still being paged
+    with ThreadPoolExecutor(max_workers=S3_MAX_WORKERS) as pool:
+        for _ in pool.map(lambda task: s3_get(*task), iter_tasks()):
+            pass
+    assert counts['keys'], 'nothing to download'
+    print('finished download of {} of {} files'.format(
+        counts['tasks'],
+        counts['keys']))
+
+
+def open_gunzip(filename):
+    try:
+        import rapidgzip
+    except ImportError:
+        return io.BufferedReader(
+            gzip.open(filename, 'rb'),
+            buffer_size=GUNZIP_BUFFER_SIZE)
+    return rapidgzip.open(filename, parallelization=os.cpu_count())
+
+
+@parsable.command
+def decompress_rows():
+    '''
+    Decompress downloaded .csv.gz partitions, in parallel if possible.
+    '''
+    mkdir_p(ROWS_RAW)
+    for filename in sorted(os.listdir(ROWS_CSV)):
+        if not filename.endswith('.csv.gz'):
+            continue
+        source = os.path.join(ROWS_CSV, filename)
+        destin = os.path.join(ROWS_RAW, filename[:-len('.gz')])
+        if os.path.exists(destin):
+            continue
+        print('decompressing {}'.format(filename))
+        try:
+            with open_gunzip(source) as src, open(destin, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+        except Exception:
+            rm_rf(destin)
+            raise
+
+
+def has_rapidgzip():
+    try:
+        import rapidgzip  # noqa: F401
+    except ImportError:
+        return False
+    return True
 
 
 @parsable.command
-def run(sample_count=1):
+def run(sample_count=1, decompress=None):
     '''
     Load; ingest; init; shuffle; infer.
+    By default rows are decompressed up front only if rapidgzip is
+    installed; otherwise ingest reads the .csv.gz partitions directly.
     '''
     name = 'taxi'
-    loom.tasks.ingest(name, SCHEMA, ROWS_CSV)
+    if decompress is None:
+        decompress = has_rapidgzip()
+    if decompress:
+        decompress_rows()
+        rows_csv = ROWS_RAW
+    else:
+        rows_csv = ROWS_CSV
+    loom.tasks.ingest(name, SCHEMA, rows_csv)
     loom.tasks.infer(name, sample_count=sample_count)
 
 
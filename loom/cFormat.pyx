@@ -214,6 +214,31 @@ cdef class Row:
             }
         }
 
+    def data_row(self):
+        '''
+        Unpack to a list of values, with None for unobserved features.
+        '''
+        assert self.ptr.pos().observed().sparsity() == SPARSITY_DENSE,\
+            SPARSITY_ERRORS[self.ptr.pos().observed().sparsity()]
+        cdef Value_cc * value = self.ptr.pos()
+        cdef Observed_cc * observed = value.observed()
+        cdef int size = observed.dense_size()
+        cdef int boolean_end = value.booleans_size()
+        cdef int count_end = boolean_end + value.counts_size()
+        cdef int i
+        cdef int pos = 0
+        cdef list data_row = [None] * size
+        for i in range(size):
+            if observed.dense(i):
+                if pos < boolean_end:
+                    data_row[i] = value.booleans(pos)
+                elif pos < count_end:
+                    data_row[i] = value.counts(pos - boolean_end)
+                else:
+                    data_row[i] = value.reals(pos - count_end)
+                pos += 1
+        return data_row
+
     def iter_data(self):
         return {
             'observed': self.iter_observed(),
@@ -27,7 +27,7 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from copy import deepcopy
-import simplejson as json
+import json
 from distributions.io.stream import open_compressed
 import loom.schema_pb2
 import loom.documented
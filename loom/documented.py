@@ -27,7 +27,6 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
-import fnmatch
 import loom
 import loom.store
 import parsable
@@ -55,59 +54,72 @@ def transform(**kwargs):
     return decorator
 
 
+def find_py_files(dirname):
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                for path in find_py_files(entry.path):
+                    yield path
+            elif entry.name.endswith('.py'):
+                yield entry.path
+
+
 def import_all_loom_modules():
-    for root, dirnames, filenames in os.walk(os.path.join(loom.ROOT, 'loom')):
-        for filename in fnmatch.filter(filenames, '*.py'):
-            path = os.path.relpath(os.path.join(root, filename), loom.ROOT)
-            module_name = path.replace('/', '.')[:-len('.py')]
-            __import__(module_name)
+    for path in find_py_files(os.path.join(loom.ROOT, 'loom')):
+        path = os.path.relpath(path, loom.ROOT)
+        module_name = path.replace('/', '.')[:-len('.py')]
+        __import__(module_name)
 
 
 def write_graphviz(datas, transforms, filename):
+    lines = []
+    o = lines.append
+
+    o('// this file was generated by {}'.format(
+        os.path.relpath(__file__, loom.ROOT)))
+    o('digraph G {')
+    o('  overlap=false;')
+    o('  graph [fontname = "helvetica"];')
+    o('  node [fontname = "helvetica"];')
+    o('  edge [fontname = "helvetica"];')
+    o('')
+    o('  // data')
+    o('  {')
+    o('    node [')
+    o('      shape=Mrecord,')
+    o('      style="filled",')
+    o('      color="#dddddd",')
+    o('      fillcolor="#eeeeee"')
+    o('    ];')
+    for name, label in datas:
+        o('    {} [label={}];'.format(name, label))
+    o('  }')
+    o('')
+    o('  // transforms')
+    o('  {')
+    o('    node [shape=box, style="filled,setlinewidth(0)"];')
+    o('')
+    for (module, name), props in transforms:
+        color = COLORS[props.get('role')]
+        label = '<{}<BR/>{}>'.format(
+            '<FONT POINT-SIZE="16">{}.</FONT>'.format(module),
+            '<FONT POINT-SIZE="24">{}</FONT>'.format(name))
+        o('    {} [label={}, fillcolor={}];'.format(name, label, color))
+    o('')
+    for (module, name), props in transforms:
+        weight = WEIGHTS[props.get('role')]
+        for data in props.get('inputs', []):
+            data = data.replace('.', '_')
+            o('    {} -> {} [weight={}];'.format(data, name, weight))
+        for data in props.get('outputs', []):
+            data = data.replace('.', '_')
+            o('    {} -> {} [weight={}];'.format(name, data, weight))
+    o('  }')
+    o('}')
+
     with open(filename, 'w') as f:
-        o = lambda line: f.write(line + '\n')
-
-        o('// this file was generated by {}'.format(
-            os.path.relpath(__file__, loom.ROOT)))
-        o('digraph G {')
-        o('  overlap=false;')
-        o('  graph [fontname = "helvetica"];')
-        o('  node [fontname = "helvetica"];')
-        o('  edge [fontname = "helvetica"];')
-        o('')
-        o('  // data')
-        o('  {')
-        o('    node [')
-        o('      shape=Mrecord,')
-        o('      style="filled",')
-        o('      color="#dddddd",')
-        o('      fillcolor="#eeeeee"')
-        o('    ];')
-        for name, label in datas:
-            o('    {} [label={}];'.format(name, label))
-        o('  }')
-        o('')
-        o('  // transforms')
-        o('  {')
-        o('    node [shape=box, style="filled,setlinewidth(0)"];')
-        o('')
-        for (module, name), props in transforms:
-            color = COLORS[props.get('role')]
-            label = '<{}<BR/>{}>'.format(
-                '<FONT POINT-SIZE="16">{}.</FONT>'.format(module),
-                '<FONT POINT-SIZE="24">{}</FONT>'.format(name))
-            o('    {} [label={}, fillcolor={}];'.format(name, label, color))
-        o('')
-        for (module, name), props in transforms:
-            weight = WEIGHTS[props.get('role')]
-            for data in props.get('inputs', []):
-                data = data.replace('.', '_')
-                o('    {} -> {} [weight={}];'.format(data, name, weight))
-            for data in props.get('outputs', []):
-                data = data.replace('.', '_')
-                o('    {} -> {} [weight={}];'.format(name, data, weight))
-        o('  }')
-        o('}')
+        f.write('\n'.join(lines))
+        f.write('\n')
 
 
 @parsable.command
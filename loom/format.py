@@ -150,7 +150,8 @@ class CategoricalEncoderBuilder(object):
     def __getstate__(self):
         return (self.name, self.model, dict(self.counts))
 
-    def __setstate__(self, name, model, counts):
+    def __setstate__(self, state):
+        name, model, counts = state
         self.name = name
         self.model = model
         self.counts = defaultdict(lambda: 0)
@@ -33,6 +33,7 @@ from distributions.lp.clustering import PitmanYor
 from loom.util import tempdir
 from distributions.io.stream import open_compressed, json_load
 import loom.schema
+import loom.schema_pb2
 import loom.hyperprior
 import loom.config
 import loom.runner
@@ -26,14 +26,19 @@
 # TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import io
 import uuid
-from itertools import chain
+import itertools
+import queue
+import threading
+import warnings
+from collections import deque
 from collections import namedtuple
 import numpy
+from google.protobuf.internal import api_implementation
 from distributions.io.stream import protobuf_stream_read
 from distributions.io.stream import protobuf_stream_write
 from loom.schema_pb2 import ProductValue
-from loom.schema_pb2 import Row
 from loom.schema_pb2 import Query
 import loom.cFormat
 import loom.runner
@@ -45,14 +50,23 @@ DEFAULTS = {
     'similar_row_limit': 1000,
     'tile_size': 500,
 }
-BUFFER_SIZE = 10
+BUFFER_SIZE = 64
+PIPE_BUFFER_SIZE = 1 << 16
+RESPONSE_BUFFER_SIZE = 1 << 17
+
+# Query.Request/Response serialization is a hot path of every query.
+if api_implementation.Type() == 'python':
+    warnings.warn(
+        'protobuf is using its pure-python backend, queries will be slow; '
+        'install a protobuf build with the upb or cpp backend')
 
 Estimate = namedtuple('Estimate', ['mean', 'variance'])
 
 
 def get_estimate(samples):
-    mean = numpy.mean(samples)
-    variance = numpy.var(samples) / len(samples)
+    samples = numpy.asarray(samples, dtype=numpy.float64)
+    mean = samples.mean()
+    variance = samples.var() / len(samples)
     return Estimate(mean, variance)
 
 
@@ -70,41 +84,61 @@ def none_to_protobuf(diff):
 
 def data_row_to_protobuf(data_row, diff):
     assert isinstance(diff, ProductValue.Diff)
-    if all([value is None for value in data_row]):
+    if not any(value is not None for value in data_row):
         none_to_protobuf(diff)
         return
     diff.Clear()
     diff.neg.observed.sparsity = NONE
     diff.pos.observed.sparsity = DENSE
-    mask = diff.pos.observed.dense
-    fields = {
-        bool: diff.pos.booleans,
-        int: diff.pos.counts,
-        float: diff.pos.reals,
-    }
+    mask_append = diff.pos.observed.dense.append
+    booleans_append = diff.pos.booleans.append
+    counts_append = diff.pos.counts.append
+    reals_append = diff.pos.reals.append
     for val in data_row:
-        observed = val is not None
-        mask.append(observed)
-        if observed:
-            fields[type(val)].append(val)
+        if val is None:
+            mask_append(False)
+            continue
+        mask_append(True)
+        val_type = val.__class__
+        if val_type is float:
+            reals_append(val)
+        elif val_type is bool:
+            booleans_append(val)
+        elif val_type is int:
+            counts_append(val)
+        else:
+            raise TypeError('unsupported data row value type: {}'.format(
+                val_type.__name__))
+
+
+def unpack_data_row(observed, booleans, counts, reals):
+    observed = list(observed)
+    packed = list(booleans)
+    packed += counts
+    packed += reals
+    data_row = [None] * len(observed)
+    pos = 0
+    for i, is_observed in enumerate(observed):
+        if is_observed:
+            data_row[i] = packed[pos]
+            pos += 1
+    return data_row
 
 
 def protobuf_to_data_row(diff):
     assert isinstance(diff, ProductValue.Diff)
     assert diff.neg.observed.sparsity == NONE
     data = diff.pos
-    packed = chain(data.booleans, data.counts, data.reals)
-    return [
-        next(packed) if observed else None
-        for observed in data.observed.dense
-    ]
+    return unpack_data_row(
+        data.observed.dense,
+        data.booleans,
+        data.counts,
+        data.reals)
 
 
 def load_data_rows(filename):
     for row in loom.cFormat.row_stream_load(filename.encode('utf-8')):
-        data = row.iter_data()
-        packed = chain(data['booleans'], data['counts'], data['reals'])
-        yield [next(packed) if observed else None for observed in data['observed']]
+        yield row.data_row()
 
 
 def feature_set_to_protobuf(feature_set, messages):
@@ -117,6 +151,8 @@ def feature_set_to_protobuf(feature_set, messages):
 class QueryServer(object):
     def __init__(self, protobuf_server):
         self.protobuf_server = protobuf_server
+        self._session_prefix = uuid.uuid4().hex[:8]
+        self._next_id = itertools.count()
 
     @property
     def root(self):
@@ -133,10 +169,10 @@ class QueryServer(object):
 
     def request(self):
         request = Query.Request()
-        request.id = str(uuid.uuid4())
+        request.id = '{}-{}'.format(self._session_prefix, next(self._next_id))
         return request
 
-    def sample(self, to_sample, conditioning_row=None, sample_count=None):
+    def _send_sample(self, to_sample, conditioning_row, sample_count, flush):
         if sample_count is None:
             sample_count = DEFAULTS['sample_sample_count']
         if conditioning_row is None:
@@ -147,7 +183,10 @@ class QueryServer(object):
         request.sample.to_sample.sparsity = DENSE
         request.sample.to_sample.dense[:] = to_sample
         request.sample.sample_count = sample_count
-        self.protobuf_server.send(request)
+        self.protobuf_server.send(request, flush)
+        return conditioning_row
+
+    def _receive_sample(self, to_sample, conditioning_row):
         response = self.protobuf_server.receive()
         if response.error:
             raise Exception('\n'.join(response.error))
@@ -161,10 +200,42 @@ class QueryServer(object):
             samples.append(data_out)
         return samples
 
-    def _send_score(self, row):
+    def sample(self, to_sample, conditioning_row=None, sample_count=None):
+        conditioning_row = self._send_sample(
+            to_sample,
+            conditioning_row,
+            sample_count,
+            flush=True)
+        return self._receive_sample(to_sample, conditioning_row)
+
+    def batch_sample(
+            self,
+            to_samples,
+            conditioning_rows,
+            sample_count=None,
+            buffer_size=BUFFER_SIZE):
+        # larger windows would overflow the bounded response queue
+        buffer_size = min(buffer_size, BUFFER_SIZE)
+        pending = deque()
+        for to_sample, conditioning_row in zip(to_samples, conditioning_rows):
+            conditioning_row = self._send_sample(
+                to_sample,
+                conditioning_row,
+                sample_count,
+                flush=False)
+            pending.append((to_sample, conditioning_row))
+            if len(pending) >= buffer_size:
+                self.protobuf_server.flush()
+                while len(pending) > buffer_size // 2:
+                    yield self._receive_sample(*pending.popleft())
+        self.protobuf_server.flush()
+        while pending:
+            yield self._receive_sample(*pending.popleft())
+
+    def _send_score(self, row, flush=True):
         request = self.request()
         data_row_to_protobuf(row, request.score.data)
-        self.protobuf_server.send(request)
+        self.protobuf_server.send(request, flush)
 
     def _receive_score(self):
         response = self.protobuf_server.receive()
@@ -177,24 +248,31 @@ class QueryServer(object):
         return self._receive_score()
 
     def batch_score(self, rows, buffer_size=BUFFER_SIZE):
-        buffered = 0
+        # larger windows would overflow the bounded response queue
+        buffer_size = min(buffer_size, BUFFER_SIZE)
+        pending = 0
         for row in rows:
-            self._send_score(row)
-            if buffered < buffer_size:
-                buffered += 1
-            else:
-                yield self._receive_score()
-        for _ in range(buffered):
+            self._send_score(row, flush=False)
+            pending += 1
+            if pending >= buffer_size:
+                # keep half a buffer of requests in flight while receiving
+                self.protobuf_server.flush()
+                while pending > buffer_size // 2:
+                    yield self._receive_score()
+                    pending -= 1
+        self.protobuf_server.flush()
+        for _ in range(pending):
             yield self._receive_score()
 
-    def _entropy(
+    def _send_entropy(
             self,
             row_sets,
             col_sets,
-            conditioning_row=None,
-            sample_count=None):
-        row_sets = list(set(map(frozenset, row_sets)) | set([frozenset()]))
-        col_sets = list(set(map(frozenset, col_sets)) | set([frozenset()]))
+            conditioning_row,
+            sample_count,
+            flush):
+        row_sets = tuple(set(map(frozenset, row_sets)) | {frozenset()})
+        col_sets = tuple(set(map(frozenset, col_sets)) | {frozenset()})
         if sample_count is None:
             sample_count = DEFAULTS['entropy_sample_count']
         request = self.request()
@@ -207,7 +285,10 @@ class QueryServer(object):
         for feature_set in col_sets:
             feature_set_to_protobuf(feature_set, request.entropy.col_sets)
         request.entropy.sample_count = sample_count
-        self.protobuf_server.send(request)
+        self.protobuf_server.send(request, flush)
+        return row_sets, col_sets
+
+    def _receive_entropy(self, row_sets, col_sets):
         response = self.protobuf_server.receive()
         if response.error:
             raise Exception('\n'.join(response.error))
@@ -216,13 +297,16 @@ class QueryServer(object):
         size = len(row_sets) * len(col_sets)
         assert len(means) == size, means
         assert len(variances) == size, variances
-        means = iter(means)
-        variances = iter(variances)
-        return {
-            row_set | col_set: Estimate(next(means), next(variances))
-            for row_set in row_sets
-            for col_set in col_sets
-        }
+        shape = (len(row_sets), len(col_sets))
+        means = numpy.reshape(means, shape).tolist()
+        variances = numpy.reshape(variances, shape).tolist()
+        result = {}
+        for row_set, row_means, row_variances in zip(
+                row_sets, means, variances):
+            for col_set, mean, variance in zip(
+                    col_sets, row_means, row_variances):
+                result[row_set | col_set] = Estimate(mean, variance)
+        return result
 
     def entropy(
             self,
@@ -236,16 +320,27 @@ class QueryServer(object):
         min_size = max(1, min(tile_size, len(row_sets), len(col_sets)))
         tile_size = tile_size * tile_size // min_size
         assert tile_size > 0, tile_size
+        # pipeline tiles as in batch_score, so they overlap on the server
+        pending = deque()
         result = {}
         for i in range(0, len(row_sets), tile_size):
             row_tile = row_sets[i: i + tile_size]
             for j in range(0, len(col_sets), tile_size):
                 col_tile = col_sets[j: j + tile_size]
-                result.update(self._entropy(
+                pending.append(self._send_entropy(
                     row_tile,
                     col_tile,
                     conditioning_row,
-                    sample_count))
+                    sample_count,
+                    flush=False))
+                if len(pending) >= BUFFER_SIZE:
+                    self.protobuf_server.flush()
+                    while len(pending) > BUFFER_SIZE // 2:
+                        tiles = pending.popleft()
+                        result.update(self._receive_entropy(*tiles))
+        self.protobuf_server.flush()
+        while pending:
+            result.update(self._receive_entropy(*pending.popleft()))
         return result
 
     def mutual_information(
@@ -288,23 +383,18 @@ class QueryServer(object):
             update_row,
             score_rows=None,
             row_limit=None):
-        row = Row()
         request = self.request()
         if row_limit is None:
             row_limit = DEFAULTS['similar_row_limit']
         if score_rows is not None:
-            for i, data_row in enumerate(score_rows):
-                data_row_to_protobuf(
-                    data_row,
-                    row.diff)
-                added_diff = request.score_derivative.score_data.add()
-                added_diff.MergeFrom(row.diff)
+            score_data = request.score_derivative.score_data
+            for data_row in score_rows:
+                data_row_to_protobuf(data_row, score_data.add())
 
         request.score_derivative.row_limit = row_limit
         data_row_to_protobuf(
             update_row,
-            row.diff)
-        request.score_derivative.update_data.MergeFrom(row.diff)
+            request.score_derivative.update_data)
 
         self.protobuf_server.send(request)
         response = self.protobuf_server.receive()
@@ -325,21 +415,54 @@ class ProtobufServer(object):
             debug=debug,
             profile=profile,
             block=False)
-
-    def send(self, request):
+        self.requests = io.BufferedWriter(
+            self.proc.stdin.raw,
+            buffer_size=PIPE_BUFFER_SIZE)
+        self.response_stream = io.BufferedReader(
+            self.proc.stdout.raw,
+            buffer_size=RESPONSE_BUFFER_SIZE)
+        self.responses = queue.Queue(maxsize=2 * BUFFER_SIZE)
+        self.reader = threading.Thread(target=self._read_responses)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read_responses(self):
+        while True:
+            try:
+                response_string = protobuf_stream_read(self.response_stream)
+                response = Query.Response()
+                response.ParseFromString(response_string)
+            except Exception as e:
+                # pass EOF or parse errors to whoever is waiting in receive()
+                self.responses.put(e)
+                return
+            self.responses.put(response)
+
+    def send(self, request, flush=True):
         assert isinstance(request, Query.Request), request
         request_string = request.SerializeToString()
-        protobuf_stream_write(request_string, self.proc.stdin)
-        self.proc.stdin.flush()
+        protobuf_stream_write(request_string, self.requests)
+        if flush:
+            self.requests.flush()
+
+    def flush(self):
+        self.requests.flush()
 
     def receive(self):
-        response_string = protobuf_stream_read(self.proc.stdout)
-        response = Query.Response()
-        response.ParseFromString(response_string)
+        response = self.responses.get()
+        if isinstance(response, Exception):
+            self.responses.put(response)
+            raise response
         return response
 
     def close(self):
-        self.proc.stdin.close()
+        self.requests.close()
+        while self.reader.is_alive():
+            # drain unclaimed responses so the reader can reach EOF
+            try:
+                self.responses.get(timeout=0.1)
+            except queue.Empty:
+                pass
         self.proc.wait()
 
     def __enter__(self):
@@ -62,7 +62,7 @@ def get_feature_rank(shared):
 def get_canonical_feature_ordering(named_features):
     features = sorted(
         (get_feature_rank(feature), name)
-        for name, feature in named_features.iteritems()
+        for name, feature in named_features.items()
     )
     pos_to_name = [name for _, name in features]
     name_to_pos = {name: pos for pos, name in enumerate(pos_to_name)}
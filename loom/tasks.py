@@ -28,12 +28,13 @@
 
 import os
 import copy
+import threading
 from distributions.io.stream import json_load
 from distributions.io.stream import open_compressed
 from distributions.io.stream import protobuf_stream_load
 from loom.util import LOG
 from loom.util import LoomError
-from loom.util import parallel_map
+from loom.util import thread_map
 import loom
 import loom.transforms
 import loom.format
@@ -50,6 +51,8 @@ DEFAULTS = {
     'sample_count': 10,
 }
 
+_GENERATE_LOCK = threading.Lock()
+
 
 @parsable.command
 def transform(
@@ -190,9 +193,10 @@ def infer(
     '''
     if not (sample_count >= 1):
         raise LoomError('Too few samples: {}'.format(sample_count))
-    parallel_map(_infer_one, [
-       (name, seed, config, debug) for seed in range(sample_count)]
-    )
+    # each sample spends its time in C++ subprocesses, so threads suffice
+    thread_map(_infer_one, [
+        (name, seed, config, debug) for seed in range(sample_count)
+    ])
 
 
 def _infer_one(*args):
@@ -228,10 +232,11 @@ def infer_one(name, seed=0, config=None, debug=False):
     loom.config.config_dump(config, sample['config'])
 
     LOG('generating init')
-    loom.generate.generate_init(
-        encoding_in=paths['ingest']['encoding'],
-        model_out=sample['init'],
-        seed=seed)
+    with _GENERATE_LOCK:  # generate_init seeds the global numpy rng
+        loom.generate.generate_init(
+            encoding_in=paths['ingest']['encoding'],
+            model_out=sample['init'],
+            seed=seed)
 
     LOG('shuffling rows')
     loom.runner.shuffle(
@@ -29,10 +29,10 @@
 import os
 from nose.tools import assert_equal
 from distributions.fileutil import tempdir
-from distributions.io.stream import protobuf_stream_load
 from distributions.tests.util import assert_close
 import loom.format
 import loom.util
+from loom.util import protobuf_stream_count
 from loom.test.util import get_test_kwargs
 from loom.test.util import CLEANUP_ON_ERROR
 from loom.test.util import assert_found
@@ -107,8 +107,8 @@ def test_import_rows(dataset):
             rows_out=rows_pbs,
         )
         assert_found(rows_pbs)
-        expected_count = sum(1 for _ in protobuf_stream_load(kwargs['rows']))
-        actual_count = sum(1 for _ in protobuf_stream_load(rows_pbs))
+        expected_count = protobuf_stream_count(kwargs['rows'])
+        actual_count = protobuf_stream_count(rows_pbs)
         assert_equal(actual_count, expected_count)
 
 
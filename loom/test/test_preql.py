@@ -28,282 +28,274 @@
 
 import os
 import csv
+import functools
 import numpy
 import pandas
 from io import StringIO
 from nose import SkipTest
-from nose.tools import assert_almost_equal
 from nose.tools import assert_equal
 from nose.tools import assert_raises
 from nose.tools import assert_true
 from distributions.fileutil import tempdir
-from distributions.io.stream import json_load
 from distributions.io.stream import open_compressed
-from distributions.io.stream import protobuf_stream_load
 from distributions.tests.util import assert_close
 import loom.preql
 from loom.format import load_encoder
+from loom.util import protobuf_stream_count
 from loom.test.util import CLEANUP_ON_ERROR
 from loom.test.util import get_test_kwargs
-from loom.test.util import load_rows_csv
+from loom.test.util import load_json
+from loom.test.util import load_rows_csv_head
 import pytest
 
 COUNT = 10
 
 
+@pytest.fixture(scope='module', params=loom.datasets.TEST_CONFIGS)
+def preql_server(request):
+    '''
+    One server per dataset, shared by the read-only query tests below.
+    '''
+    kwargs = get_test_kwargs(request.param)
+    with loom.preql.get_server(kwargs['root'], debug=True) as preql:
+        yield preql, kwargs
+
+
+def load_rows_df(rows_csv):
+    frames = []
+    for filename in os.listdir(rows_csv):
+        with open_compressed(os.path.join(rows_csv, filename)) as f:
+            frames.append(pandas.read_csv(f, dtype=str, keep_default_na=False))
+    return pandas.concat(frames, ignore_index=True)
+
+
 def make_fully_observed_row(rows_csv):
-    rows = iter(load_rows_csv(rows_csv))
-    header = next(rows)
-    try:
-        id_pos = header.index('_id')
-    except ValueError:
-        id_pos = None
-    dense_row = ['' for _ in header]
-    for row in rows:
-        if not any(condition == '' for condition in dense_row):
-            if id_pos is not None:
-                dense_row.pop(id_pos)
-            return dense_row
+    rows_df = load_rows_df(rows_csv)
+    if '_id' in rows_df.columns:
+        rows_df = rows_df.drop(columns='_id')
+    if rows_df.empty:
+        raise SkipTest('no dense row could be constructed')
+    # take the first observed value of each column
+    dense_row = rows_df.mask(rows_df == '').bfill().iloc[0]
+    if dense_row.isnull().any():
+        raise SkipTest('no dense row could be constructed')
+    return dense_row.tolist()
+
 
-        for i, (condition, x) in enumerate(zip(dense_row, row)):
-            if condition == '':
-                dense_row[i] = x
-    raise SkipTest('no dense row could be constructed')
+@functools.lru_cache(maxsize=None)
+def load_name_to_encoder(encoding):
+    return {e['name']: load_encoder(e) for e in load_json(encoding)}
 
 
 def _check_predictions(rows_in, result_out, encoding):
-    encoders = json_load(encoding)
-    name_to_encoder = {e['name']: load_encoder(e) for e in encoders}
-    with open_compressed(rows_in, 'rt') as fin:
-        with open(result_out, 'r') as fout:
-            in_reader = csv.reader(fin)
-            out_reader = csv.reader(fout)
-            fnames = next(in_reader)
-            next(out_reader)
-            for in_row in in_reader:
-                for i in range(COUNT):
-                    out_row = next(out_reader)
-                    bundle = zip(fnames, in_row, out_row)
-                    for name, in_val, out_val in bundle:
-                        if name == '_id':
-                            assert_equal(in_val, out_val)
-                            continue
-                        encode = name_to_encoder[name]
-                        observed = bool(in_val.strip())
-                        if observed:
-                            assert_almost_equal(encode(in_val), encode(out_val))
-                        else:
-                            assert_true(bool(out_val.strip()))
+    name_to_encoder = load_name_to_encoder(encoding)
+    with open_compressed(rows_in, 'rt') as f:
+        in_df = pandas.read_csv(f, dtype=str, keep_default_na=False)
+    out_df = pandas.read_csv(result_out, dtype=str, keep_default_na=False)
+    assert_equal(out_df.shape[0], in_df.shape[0] * COUNT)
+    for pos, name in enumerate(in_df.columns):
+        # each input row is followed by COUNT predicted rows
+        in_vals = numpy.repeat(in_df[name].values, COUNT)
+        out_vals = out_df.iloc[:, pos].values
+        if name == '_id':
+            assert_equal(list(in_vals), list(out_vals))
+            continue
+        encode = name_to_encoder[name]
+        observed = pandas.Series(in_vals).str.strip().ne('').values
+        in_encoded = numpy.array(
+            [encode(val) for val in in_vals[observed]],
+            dtype=float)
+        out_encoded = numpy.array(
+            [encode(val) for val in out_vals[observed]],
+            dtype=float)
+        numpy.testing.assert_array_almost_equal(
+            in_encoded,
+            out_encoded,
+            decimal=7)
+        unobserved_out = pandas.Series(out_vals[~observed]).str.strip()
+        assert_true(unobserved_out.ne('').all())
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_predict(dataset):
+def test_predict(preql_server):
     with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
-        kwargs = get_test_kwargs(dataset)
-        root = kwargs['root']
+        preql, kwargs = preql_server
         rows_csv = kwargs['rows_csv']
         encoding = kwargs['encoding']
-        with loom.preql.get_server(root, debug=True) as preql:
-            result_out = 'predictions_out.csv'
-            rows_in = os.listdir(rows_csv)[0]
-            rows_in = os.path.join(rows_csv, rows_in)
-            preql.predict(rows_in, COUNT, result_out, id_offset=True)
-            print('DEBUG', open_compressed(rows_in).read())
-            print('DEBUG', open_compressed(result_out).read())
-            _check_predictions(rows_in, result_out, encoding)
+        result_out = 'predictions_out.csv'
+        rows_in = os.listdir(rows_csv)[0]
+        rows_in = os.path.join(rows_csv, rows_in)
+        preql.predict(rows_in, COUNT, result_out, id_offset=True)
+        print('DEBUG', open_compressed(rows_in).read())
+        print('DEBUG', open_compressed(result_out).read())
+        _check_predictions(rows_in, result_out, encoding)
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_predict_pandas(dataset):
-    kwargs = get_test_kwargs(dataset)
+def test_predict_pandas(preql_server):
+    preql, kwargs = preql_server
     schema = kwargs['schema']
-    root = kwargs['root']
     rows_csv = kwargs['rows_csv']
-    feature_count = len(json_load(schema))
-    with loom.preql.get_server(root, debug=True) as preql:
-        rows_filename = os.path.join(rows_csv, os.listdir(rows_csv)[0])
-        with open_compressed(rows_filename) as f:
-            rows_df = pandas.read_csv(
-                f,
-                converters=preql.converters,
-                index_col='_id')
-        print('rows_df =')
-        print(rows_df)
-        row_count = rows_df.shape[0]
-        assert_equal(rows_df.shape[1], feature_count)
-        rows_io = StringIO(rows_df.to_csv())
-        result_string = preql.predict(rows_io, COUNT, id_offset=True)
-        result_df = pandas.read_csv(StringIO(result_string), index_col=False)
-        print('result_df =')
-        print(result_df)
-        assert_equal(result_df.ndim, 2)
-        assert_equal(result_df.shape[0], row_count * COUNT)
-        assert_equal(result_df.shape[1], 1 + feature_count)
+    feature_count = len(load_json(schema))
+    rows_filename = os.path.join(rows_csv, os.listdir(rows_csv)[0])
+    with open_compressed(rows_filename) as f:
+        rows_df = pandas.read_csv(
+            f,
+            converters=preql.converters,
+            index_col='_id')
+    print('rows_df =')
+    print(rows_df)
+    row_count = rows_df.shape[0]
+    assert_equal(rows_df.shape[1], feature_count)
+    rows_io = StringIO(rows_df.to_csv())
+    result_string = preql.predict(rows_io, COUNT, id_offset=True)
+    result_df = pandas.read_csv(StringIO(result_string), index_col=False)
+    print('result_df =')
+    print(result_df)
+    assert_equal(result_df.ndim, 2)
+    assert_equal(result_df.shape[0], row_count * COUNT)
+    assert_equal(result_df.shape[1], 1 + feature_count)
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_relate(dataset):
+def test_relate(preql_server):
     with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
-        kwargs = get_test_kwargs(dataset)
-        root = kwargs['root']
-        with loom.preql.get_server(root, debug=True) as preql:
-            result_out = 'related_out.csv'
-            preql.relate(preql.feature_names, result_out, sample_count=10)
-            with open(result_out, 'r') as f:
-                reader = csv.reader(f)
-                header = next(reader)
-                columns = header[1:]
-                assert_equal(columns, preql.feature_names)
-                zmatrix = numpy.zeros((len(columns), len(columns)))
-                for i, row in enumerate(reader):
-                    column = row.pop(0)
-                    assert_equal(column, preql.feature_names[i])
-                    for j, score in enumerate(row):
-                        score = float(score)
-                        zmatrix[i][j] = score
-                assert_close(zmatrix, zmatrix.T)
+        preql, kwargs = preql_server
+        result_out = 'related_out.csv'
+        preql.relate(preql.feature_names, result_out, sample_count=10)
+        result_df = pandas.read_csv(
+            result_out,
+            index_col=0,
+            dtype=str,
+            keep_default_na=False)
+        assert_equal(list(result_df.columns), preql.feature_names)
+        assert_equal(list(result_df.index), preql.feature_names)
+        zmatrix = result_df.to_numpy(dtype=float)
+        assert_close(zmatrix, zmatrix.T)
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_relate_pandas(dataset):
-    kwargs = get_test_kwargs(dataset)
+def test_relate_pandas(preql_server):
+    preql, kwargs = preql_server
     schema = kwargs['schema']
-    root = kwargs['root']
-    feature_count = len(json_load(schema))
-    with loom.preql.get_server(root, debug=True) as preql:
-        result_string = preql.relate(preql.feature_names)
-        result_df = pandas.read_csv(StringIO(result_string), index_col=0)
-        print('result_df =')
-        print(result_df)
-        assert_equal(result_df.ndim, 2)
-        assert_equal(result_df.shape[0], feature_count)
-        assert_equal(result_df.shape[1], feature_count)
+    feature_count = len(load_json(schema))
+    result_string = preql.relate(preql.feature_names)
+    result_df = pandas.read_csv(StringIO(result_string), index_col=0)
+    print('result_df =')
+    print(result_df)
+    assert_equal(result_df.ndim, 2)
+    assert_equal(result_df.shape[0], feature_count)
+    assert_equal(result_df.shape[1], feature_count)
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_refine_with_conditions(dataset):
-    kwargs = get_test_kwargs(dataset)
-    root = kwargs['root']
+def test_refine_with_conditions(preql_server):
+    preql, kwargs = preql_server
     rows_csv = kwargs['rows_csv']
-    with loom.preql.get_server(root, debug=True) as preql:
-        features = preql.feature_names
-        conditions = make_fully_observed_row(rows_csv)
-        preql.refine(
-            target_feature_sets=None,
-            query_feature_sets=None,
-            conditioning_row=None)
-        target_feature_sets = [
-            [features[0], features[1]],
-            [features[2]]]
-        query_feature_sets = [
-            [features[0], features[1]],
-            [features[2]],
-            [features[3]]]
-        assert_raises(
-            ValueError,
-            preql.refine,
-            target_feature_sets,
-            query_feature_sets,
-            conditions)
-        conditions[0] = None
-        assert_raises(
-            ValueError,
-            preql.refine,
-            target_feature_sets,
-            query_feature_sets,
-            conditions)
-        conditions[1] = None
-        conditions[2] = None
-        conditions[3] = None
-        preql.refine(
-            target_feature_sets,
-            query_feature_sets,
-            conditions)
+    features = preql.feature_names
+    conditions = make_fully_observed_row(rows_csv)
+    preql.refine(
+        target_feature_sets=None,
+        query_feature_sets=None,
+        conditioning_row=None)
+    target_feature_sets = [
+        [features[0], features[1]],
+        [features[2]]]
+    query_feature_sets = [
+        [features[0], features[1]],
+        [features[2]],
+        [features[3]]]
+    assert_raises(
+        ValueError,
+        preql.refine,
+        target_feature_sets,
+        query_feature_sets,
+        conditions)
+    conditions[0] = None
+    assert_raises(
+        ValueError,
+        preql.refine,
+        target_feature_sets,
+        query_feature_sets,
+        conditions)
+    conditions[1] = None
+    conditions[2] = None
+    conditions[3] = None
+    preql.refine(
+        target_feature_sets,
+        query_feature_sets,
+        conditions)
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_refine_shape(dataset):
-    kwargs = get_test_kwargs(dataset)
-    root = kwargs['root']
-    with loom.preql.get_server(root, debug=True) as preql:
-        features = preql.feature_names
-        target_sets = [
-            features[2 * i : 2 * (i + 1)] for i in range(len(features) // 2)
-        ]
-        query_sets = [
-            features[2 * i : 2 * (i + 1)] for i in range(len(features) // 2)
-        ]
-        result = preql.refine(target_sets, query_sets, sample_count=10)
-        reader = csv.reader(StringIO(result))
-        header = next(reader)
-        header.pop(0)
-        assert_equal(header, list(map(min, query_sets)))
-        for row, target_set in zip(reader, target_sets):
-            label = row.pop(0)
-            assert_equal(label, min(target_set))
-            assert_equal(len(row), len(query_sets))
+def test_refine_shape(preql_server):
+    preql, kwargs = preql_server
+    features = preql.feature_names
+    target_sets = [
+        features[2 * i : 2 * (i + 1)] for i in range(len(features) // 2)
+    ]
+    query_sets = [
+        features[2 * i : 2 * (i + 1)] for i in range(len(features) // 2)
+    ]
+    result = preql.refine(target_sets, query_sets, sample_count=10)
+    reader = csv.reader(StringIO(result))
+    header = next(reader)
+    header.pop(0)
+    assert_equal(header, list(map(min, query_sets)))
+    for row, target_set in zip(reader, target_sets):
+        label = row.pop(0)
+        assert_equal(label, min(target_set))
+        assert_equal(len(row), len(query_sets))
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_support_with_conditions(dataset):
-    kwargs = get_test_kwargs(dataset)
-    root = kwargs['root']
+def test_support_with_conditions(preql_server):
+    preql, kwargs = preql_server
     rows_csv = kwargs['rows_csv']
-    with loom.preql.get_server(root, debug=True) as preql:
-        features = preql.feature_names
-        conditions = make_fully_observed_row(rows_csv)
-        target_feature_sets = [
-            [features[0], features[1]],
-            [features[2]]]
-        observed_feature_sets = [
-            [features[0], features[1]],
-            [features[2]],
-            [features[3]]]
-        preql.support(
-            target_feature_sets,
-            observed_feature_sets,
-            conditions)
-        conditions[5] = None
-        preql.support(
-            target_feature_sets,
-            observed_feature_sets,
-            conditions)
-        conditions[0] = None
-        assert_raises(
-            ValueError,
-            preql.support,
-            target_feature_sets,
-            observed_feature_sets,
-            conditions)
+    features = preql.feature_names
+    conditions = make_fully_observed_row(rows_csv)
+    target_feature_sets = [
+        [features[0], features[1]],
+        [features[2]]]
+    observed_feature_sets = [
+        [features[0], features[1]],
+        [features[2]],
+        [features[3]]]
+    preql.support(
+        target_feature_sets,
+        observed_feature_sets,
+        conditions)
+    conditions[5] = None
+    preql.support(
+        target_feature_sets,
+        observed_feature_sets,
+        conditions)
+    conditions[0] = None
+    assert_raises(
+        ValueError,
+        preql.support,
+        target_feature_sets,
+        observed_feature_sets,
+        conditions)
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_support_shape(dataset):
-    kwargs = get_test_kwargs(dataset)
-    root = kwargs['root']
+def test_support_shape(preql_server):
+    preql, kwargs = preql_server
     rows_csv = kwargs['rows_csv']
-    with loom.preql.get_server(root, debug=True) as preql:
-        features = preql.feature_names
-        conditioning_row = make_fully_observed_row(rows_csv)
-        target_sets = [
-            features[2 * i : 2 * (i + 1)] for i in range(len(features) // 2)
-        ]
-        observed_sets = [
-            features[2 * i : 2 * (i + 1)] for i in range(len(features) // 2)
-        ]
-        result = preql.support(
-            target_sets,
-            observed_sets,
-            conditioning_row,
-            sample_count=10)
-        reader = csv.reader(StringIO(result))
-        header = next(reader)
-        header.pop(0)
-        assert_equal(header, list(map(min, observed_sets)))
-        for row, target_set in zip(reader, target_sets):
-            label = row.pop(0)
-            assert_equal(label, min(target_set))
-            assert_equal(len(row), len(observed_sets))
+    features = preql.feature_names
+    conditioning_row = make_fully_observed_row(rows_csv)
+    target_sets = [
+        features[2 * i : 2 * (i + 1)] for i in range(len(features) // 2)
+    ]
+    observed_sets = [
+        features[2 * i : 2 * (i + 1)] for i in range(len(features) // 2)
+    ]
+    result = preql.support(
+        target_sets,
+        observed_sets,
+        conditioning_row,
+        sample_count=10)
+    reader = csv.reader(StringIO(result))
+    header = next(reader)
+    header.pop(0)
+    assert_equal(header, list(map(min, observed_sets)))
+    for row, target_set in zip(reader, target_sets):
+        label = row.pop(0)
+        assert_equal(label, min(target_set))
+        assert_equal(len(row), len(observed_sets))
 
 
 @pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
@@ -314,67 +306,54 @@ def test_group_runs(dataset):
     schema = kwargs['schema']
     with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
         with loom.preql.get_server(root, encoding, debug=True) as preql:
-            test_columns = list(json_load(schema).keys())[:10]
+            test_columns = list(load_json(schema).keys())[:10]
             for column in test_columns:
                 groupings_csv = 'group.{}.csv'.format(column)
                 preql.group(column, result_out=groupings_csv)
                 print(open(groupings_csv).read())
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_group_pandas(dataset):
-    kwargs = get_test_kwargs(dataset)
+def test_group_pandas(preql_server):
+    preql, kwargs = preql_server
     rows = kwargs['rows']
-    root = kwargs['root']
-    row_count = sum(1 for _ in protobuf_stream_load(rows))
-    with loom.preql.get_server(root, debug=True) as preql:
-        feature_names = preql.feature_names
-        for feature in feature_names[:10]:
-            result_string = preql.group(feature)
-            result_df = pandas.read_csv(StringIO(result_string), index_col=0)
-            print('result_df =')
-            print(result_df)
-            assert_equal(result_df.ndim, 2)
-            assert_equal(result_df.shape[0], row_count)
-            assert_equal(result_df.shape[1], 2)
+    row_count = protobuf_stream_count(rows)
+    feature_names = preql.feature_names
+    for feature in feature_names[:10]:
+        result_string = preql.group(feature)
+        result_df = pandas.read_csv(StringIO(result_string), index_col=0)
+        print('result_df =')
+        print(result_df)
+        assert_equal(result_df.ndim, 2)
+        assert_equal(result_df.shape[0], row_count)
+        assert_equal(result_df.shape[1], 2)
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_search_runs(dataset):
-    kwargs = get_test_kwargs(dataset)
+def test_search_runs(preql_server):
+    preql, kwargs = preql_server
     rows_csv = kwargs['rows_csv']
-    root = kwargs['root']
-    rows = load_rows_csv(rows_csv)
-    header = rows.pop(0)
+    header, rows = load_rows_csv_head(rows_csv, 10)
     try:
         id_pos = header.index('_id')
     except ValueError:
         id_pos = None
-    rows = rows[0:10]
     with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
-        with loom.preql.get_server(root, debug=True) as preql:
-            for i, row in enumerate(rows):
-                row.pop(id_pos)
-                search_csv = 'search.{}.csv'.format(i)
-                preql.search(row, result_out=search_csv)
-                open(search_csv).read()
+        for i, row in enumerate(rows):
+            row.pop(id_pos)
+            search_csv = 'search.{}.csv'.format(i)
+            preql.search(row, result_out=search_csv)
+            open(search_csv).read()
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_similar_runs(dataset):
-    kwargs = get_test_kwargs(dataset)
+def test_similar_runs(preql_server):
+    preql, kwargs = preql_server
     rows_csv = kwargs['rows_csv']
-    root = kwargs['root']
-    rows = load_rows_csv(rows_csv)
-    header = rows.pop(0)
+    header, rows = load_rows_csv_head(rows_csv, 10)
     try:
         id_pos = header.index('_id')
     except ValueError:
         id_pos = None
-    rows = rows[0:10]
     for row in rows:
         row.pop(id_pos)
     with tempdir(cleanup_on_error=CLEANUP_ON_ERROR):
-      with loom.preql.get_server(root, debug=True) as preql:
-          search_csv = 'search.csv'
-          preql.similar(rows, result_out=search_csv)
+        search_csv = 'search.csv'
+        preql.similar(rows, result_out=search_csv)
@@ -26,29 +26,33 @@
 # TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy
 from nose.tools import assert_equal
 from nose.tools import assert_set_equal
 from nose.tools import assert_not_equal
 from nose.tools import assert_true
-from distributions.dbg.random import sample_bernoulli
-from distributions.io.stream import json_load
 from distributions.io.stream import open_compressed
-from distributions.fileutil import tempdir
 from loom.schema_pb2 import ProductValue, CrossCat, Query
 from loom.test.util import get_test_kwargs
+from loom.test.util import get_seeded_config
+from loom.test.util import load_json
 import loom.query
 from loom.query import protobuf_to_data_row
-import loom.config
+import loom.schema
 from loom.test.util import load_rows
 import pytest
 
 NONE = ProductValue.Observed.NONE
 DENSE = ProductValue.Observed.DENSE
+MODEL_NAMES = tuple(loom.schema.MODELS.keys())
 
 
 def set_observed(observed, observed_dense):
     observed.sparsity = DENSE
-    observed.dense[:] = observed_dense
+    del observed.dense[:]
+    observed.dense.extend(observed_dense)
 
 
 def set_diff(diff, observed_dense):
@@ -56,19 +60,22 @@ def set_diff(diff, observed_dense):
     set_observed(diff.pos.observed, observed_dense)
 
 
-def get_example_requests(model, rows, query_type='mixed'):
-    assert query_type in ['sample', 'score', 'mixed']
+@functools.lru_cache(maxsize=None)
+def get_nontrivials(model):
+    '''
+    Return a tuple marking features whose shared model can be sampled,
+    parsed once per model file.
+    '''
     cross_cat = CrossCat()
     with open_compressed(model, 'rb') as f:
         cross_cat.ParseFromString(f.read())
     feature_count = sum(len(kind.featureids) for kind in cross_cat.kinds)
-    featureids = range(feature_count)
-
     nontrivials = [True] * feature_count
     for kind in cross_cat.kinds:
         fs = iter(kind.featureids)
-        for model in loom.schema.MODELS.keys():
-            for shared in getattr(kind.product_model, model):
+        product_model = kind.product_model
+        for model in MODEL_NAMES:
+            for shared in getattr(product_model, model):
                 f = next(fs)
                 if model == 'dd':
                     if len(shared.alphas) == 0:
@@ -76,40 +83,43 @@ def get_example_requests(model, rows, query_type='mixed'):
                 elif model == 'dpd':
                     if len(shared.betas) == 0:
                         nontrivials[f] = False
-    all_observed = nontrivials[:]
+    return tuple(nontrivials)
+
+
+def get_example_requests(model, rows, query_type='mixed'):
+    assert query_type in ['sample', 'score', 'mixed']
+    nontrivials = list(get_nontrivials(model))
+    feature_count = len(nontrivials)
     none_observed = [False] * feature_count
 
-    observeds = []
-    observeds.append(all_observed)
-    for f, nontrivial in zip(featureids, nontrivials):
-        if nontrivial:
-            observed = all_observed[:]
-            observed[f] = False
-            observeds.append(observed)
-    for f in featureids:
-        observed = [
-            nontrivial and sample_bernoulli(0.5)
-            for nontrivial in nontrivials
-        ]
-        observeds.append(observed)
-    for f, nontrivial in zip(featureids, nontrivials):
-        if nontrivial:
-            observed = none_observed[:]
-            observed[f] = True
-            observeds.append(observed)
-    observeds.append(none_observed)
+    nontrivial_mask = numpy.array(nontrivials, dtype=bool)
+    eye = numpy.eye(feature_count, dtype=bool)
+    random_observeds = numpy.random.randint(
+        0, 2,
+        size=(feature_count, feature_count)).astype(bool)
+    observeds = numpy.concatenate([
+        nontrivial_mask[numpy.newaxis],  # all observed
+        (nontrivial_mask & ~eye)[nontrivial_mask],  # all but one observed
+        random_observeds & nontrivial_mask,
+        eye[nontrivial_mask],  # one observed
+        numpy.zeros((1, feature_count), dtype=bool),  # none observed
+    ]).tolist()
+
+    template = Query.Request()
+    if query_type in ['sample', 'mixed']:
+        set_diff(template.sample.data, none_observed)
+        template.sample.to_sample.sparsity = DENSE
+        template.sample.sample_count = 1
+    if query_type in ['score', 'mixed']:
+        set_diff(template.score.data, none_observed)
 
     requests = []
     for i, observed in enumerate(observeds):
         request = Query.Request()
+        request.CopyFrom(template)
         request.id = 'example-{}'.format(i)
         if query_type in ['sample', 'mixed']:
-            set_diff(request.sample.data, none_observed)
-            request.sample.to_sample.sparsity = DENSE
-            request.sample.to_sample.dense[:] = observed
-            request.sample.sample_count = 1
-        if query_type in ['score', 'mixed']:
-            set_diff(request.score.data, none_observed)
+            request.sample.to_sample.dense.extend(observed)
         requests.append(request)
     for row in load_rows(rows)[:20]:
         i += 1
@@ -144,18 +154,25 @@ def get_response(server, request):
 def _test_server(root, requests):
     with loom.query.ProtobufServer(root, debug=True) as protobuf_server:
         server = loom.query.QueryServer(protobuf_server)
+        to_samples = []
+        sample_rows = []
+        score_rows = []
         for request in requests:
             response = get_response(protobuf_server, request)
             check_response(request, response)
             if request.HasField('sample'):
                 assert_equal(len(response.sample.samples), 1)
-                pod_request = protobuf_to_data_row(request.sample.data)
-                to_sample = request.sample.to_sample.dense[:]
-                server.sample(to_sample, pod_request)
+                sample_rows.append(protobuf_to_data_row(request.sample.data))
+                to_samples.append(request.sample.to_sample.dense[:])
             if request.HasField('score'):
                 assert_true(isinstance(response.score.score, float))
-                pod_request = protobuf_to_data_row(request.score.data)
-                server.score(pod_request)
+                score_rows.append(protobuf_to_data_row(request.score.data))
+        samples = list(server.batch_sample(to_samples, sample_rows))
+        assert_equal(len(samples), len(sample_rows))
+        scores = list(server.batch_score(score_rows))
+        assert_equal(len(scores), len(score_rows))
+        for score in scores:
+            assert_true(isinstance(score, float))
 
 
 @pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
@@ -178,52 +195,70 @@ def test_score(dataset):
     _test_server(root, requests)
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_batch_score(dataset):
-    kwargs = get_test_kwargs(dataset)
-    model = kwargs['model']
-    rows = kwargs['rows']
-    root = kwargs['root']
-    requests = get_example_requests(model, rows, 'score')
-    with loom.query.get_server(root, debug=True) as server:
-        rows = [
-            protobuf_to_data_row(request.score.data)
-            for request in requests
-        ]
-        scores = list(server.batch_score(rows))
-        assert_equal(len(scores), len(rows))
+@pytest.fixture(scope='module', params=loom.datasets.TEST_CONFIGS)
+def query_server(request):
+    kwargs = get_test_kwargs(request.param)
+    with loom.query.get_server(kwargs['root'], debug=True) as server:
+        yield server, kwargs
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_score_derivative_runs(dataset):
-    kwargs = get_test_kwargs(dataset)
+def test_batch_score(query_server):
+    server, kwargs = query_server
+    model = kwargs['model']
     rows = kwargs['rows']
-    root = kwargs['root']
-    with loom.query.get_server(root, debug=True) as server:
-        rows = load_rows(rows)
-        target_row = protobuf_to_data_row(rows[0].diff)
-        score_rows = [protobuf_to_data_row(r.diff) for r in rows[:2]]
-        results = server.score_derivative(target_row, score_rows)
-        assert len(list(results)) == len(score_rows)
+    requests = get_example_requests(model, rows, 'score')
+    rows = (
+        protobuf_to_data_row(request.score.data)
+        for request in requests
+    )
+    scores = list(server.batch_score(rows))
+    assert_equal(len(scores), len(requests))
 
 
 @pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_score_derivative_against_existing_runs(dataset):
-    kwargs = get_test_kwargs(dataset)
-    rows = kwargs['rows']
-    root = kwargs['root']
-    with loom.query.get_server(root, debug=True) as server:
-        rows = load_rows(rows)
-        target_row = protobuf_to_data_row(rows[0].diff)
-        results = server.score_derivative(
-            target_row,
-            score_rows=None)
-        assert len(rows) == len(list(results))
-        results = server.score_derivative(
-            target_row,
-            score_rows=None,
-            row_limit=1)
-        assert len(list(results)) == 1
+def test_load_data_rows(dataset):
+    rows = get_test_kwargs(dataset)['rows']
+    expected = [protobuf_to_data_row(row.diff) for row in load_rows(rows)]
+    actual = list(loom.query.load_data_rows(rows))
+    assert_equal(actual, expected)
+
+
+def test_score_derivative_runs(query_server):
+    server, kwargs = query_server
+    rows = load_rows(kwargs['rows'])
+    target_row = protobuf_to_data_row(rows[0].diff)
+    score_rows = [protobuf_to_data_row(r.diff) for r in rows[:2]]
+    results = server.score_derivative(target_row, score_rows)
+    assert len(list(results)) == len(score_rows)
+
+
+def test_score_derivative_against_existing_runs(query_server):
+    server, kwargs = query_server
+    rows = load_rows(kwargs['rows'])
+    target_row = protobuf_to_data_row(rows[0].diff)
+    results = server.score_derivative(
+        target_row,
+        score_rows=None)
+    assert len(rows) == len(list(results))
+    results = server.score_derivative(
+        target_row,
+        score_rows=None,
+        row_limit=1)
+    assert len(list(results)) == 1
+
+
+def _run_seed(root, seed, requests):
+    config = get_seeded_config(seed)
+    responses = []
+    with loom.query.ProtobufServer(root, config=config) as server:
+        # pipeline in chunks small enough for the server's response queue
+        for i in range(0, len(requests), loom.query.BUFFER_SIZE):
+            chunk = requests[i: i + loom.query.BUFFER_SIZE]
+            for request in chunk:
+                server.send(request, flush=False)
+            server.flush()
+            responses += [server.receive() for _ in chunk]
+    return responses
 
 
 @pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
@@ -233,39 +268,27 @@ def test_seed(dataset):
     rows = kwargs['rows']
     root = kwargs['root']
     requests = get_example_requests(model, rows, 'mixed')
-    with tempdir():
-        loom.config.config_dump({'seed': 0}, 'config.pb.gz')
-        with loom.query.ProtobufServer(root, config='config.pb.gz') as server:
-            responses1 = [get_response(server, req) for req in requests]
-
-    with tempdir():
-        loom.config.config_dump({'seed': 0}, 'config.pb.gz')
-        with loom.query.ProtobufServer(root, config='config.pb.gz') as server:
-            responses2 = [get_response(server, req) for req in requests]
-
-    with tempdir():
-        loom.config.config_dump({'seed': 10}, 'config.pb.gz')
-        with loom.query.ProtobufServer(root, config='config.pb.gz') as server:
-            responses3 = [get_response(server, req) for req in requests]
+    seeds = [0, 0, 10]
+    with ThreadPoolExecutor(max_workers=len(seeds)) as pool:
+        responses1, responses2, responses3 = pool.map(
+            functools.partial(_run_seed, root, requests=requests),
+            seeds)
 
     assert_equal(responses1, responses2)
     assert_not_equal(responses1, responses3)
 
 
-@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
-def test_tiled_entropy(dataset):
-    kwargs = get_test_kwargs(dataset)
-    feature_count = len(json_load(kwargs['schema']))
-    root = kwargs['root']
+def test_tiled_entropy(query_server):
+    server, kwargs = query_server
+    feature_count = len(load_json(kwargs['schema']))
     feature_sets = [frozenset([i]) for i in range(feature_count)]
     kwargs = {
         'row_sets': feature_sets,
         'col_sets': feature_sets,
         'sample_count': 10
     }
-    with loom.query.get_server(root, debug=True) as server:
-        expected = set(server.entropy(**kwargs))
-        for tile_size in range(1, 1 + feature_count):
-            print('tile_size = {}'.format(tile_size))
-            actual = set(server.entropy(tile_size=tile_size, **kwargs))
-            assert_set_equal(expected, actual)
+    expected = set(server.entropy(**kwargs))
+    for tile_size in range(1, 1 + feature_count):
+        print('tile_size = {}'.format(tile_size))
+        actual = set(server.entropy(tile_size=tile_size, **kwargs))
+        assert_set_equal(expected, actual)
@@ -32,13 +32,13 @@ from nose.tools import assert_almost_equal
 from nose.tools import assert_greater
 from nose.tools import assert_less
 from nose.tools import assert_less_equal
-from distributions.fileutil import tempdir
 from goftests import density_goodness_of_fit
 from goftests import discrete_goodness_of_fit
 import loom.datasets
 import loom.preql
 import loom.query
 from loom.test.util import get_test_kwargs, load_rows
+from loom.test.util import get_seeded_config
 import pytest
 
 
@@ -73,23 +73,24 @@ def _check_marginal_samples_match_scores(server, row, fi):
     val = samples[0][fi]
     base_score = server.score(row)
     if isinstance(val, bool) or isinstance(val, int):
-        probs_dict = {}
         samples = [sample[fi] for sample in samples]
-        for sample in set(samples):
-            row[fi] = sample
-            probs_dict[sample] = numpy.exp(
-                server.score(row) - base_score)
+        values = list(set(samples))
+        score_rows = []
+        for value in values:
+            score_row = list(row)
+            score_row[fi] = value
+            score_rows.append(score_row)
+        scores = numpy.fromiter(server.batch_score(score_rows), dtype=float)
+        probs_dict = dict(zip(values, numpy.exp(scores - base_score)))
         if len(probs_dict) == 1:
-            assert_almost_equal(probs_dict[sample], 1., places=SCORE_PLACES)
+            assert_almost_equal(probs_dict[values[0]], 1., places=SCORE_PLACES)
             return
         if min(probs_dict.values()) < MIN_CATEGORICAL_PROB:
             return
         gof = discrete_goodness_of_fit(samples, probs_dict, plot=True)
     elif isinstance(val, float):
-        probs = numpy.exp([
-            server.score(sample) - base_score
-            for sample in samples
-        ])
+        scores = numpy.fromiter(server.batch_score(samples), dtype=float)
+        probs = numpy.exp(scores - base_score)
         samples = [sample[fi] for sample in samples]
         gof = density_goodness_of_fit(samples, probs, plot=True)
     assert_greater(gof, MIN_GOODNESS_OF_FIT)
@@ -100,11 +101,10 @@ def test_samples_match_scores(dataset):
     kwargs = get_test_kwargs(dataset)
     rows = load_rows(kwargs['rows'])
     rows = rows[:: len(rows) // 5]
-    with tempdir():
-        loom.config.config_dump({'seed': SEED}, 'config.pb.gz')
-        with loom.query.get_server(kwargs['root'], 'config.pb.gz', debug=True) as server:
-            for row in rows:
-                _check_marginal_samples_match_scores(server, row, 0)
+    config = get_seeded_config(SEED)
+    with loom.query.get_server(kwargs['root'], config, debug=True) as server:
+        for row in rows:
+            _check_marginal_samples_match_scores(server, row, 0)
 
 
 @pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
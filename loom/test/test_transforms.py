@@ -28,6 +28,7 @@
 
 import os
 import numpy.random
+from nose.tools import assert_equal, assert_not_in
 from distributions.fileutil import tempdir
 import loom.store
 import loom.transforms
@@ -75,3 +76,15 @@ def test_transforms():
         loom.tasks.transform(name, schema_csv, rows_csv)
         loom.tasks.ingest(name)
         loom.tasks.infer(name, sample_count=1)
+
+
+def test_sparse_real_tares_zeros():
+    transform = loom.transforms.SparseRealTransform('x')
+    row_dict = {'x': '0'}
+    transform.forward(row_dict)
+    assert_equal(row_dict['x.nonzero'], loom.transforms.FALSE_TOKEN)
+    assert_not_in('x.value', row_dict)
+    row_dict = {'x': '1.5'}
+    transform.forward(row_dict)
+    assert_equal(row_dict['x.nonzero'], loom.transforms.TRUE_TOKEN)
+    assert_equal(row_dict['x.value'], 1.5)
@@ -27,6 +27,8 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+from nose.tools import assert_equal
+from distributions.io.stream import protobuf_stream_load
 import loom.util
 from loom.test.util import get_test_kwargs
 import pytest
@@ -39,11 +41,43 @@ def test_cat(dataset):
     _test_cat(name, kwargs)
 
 
+@pytest.mark.parametrize('dataset', loom.datasets.TEST_CONFIGS)
+def test_protobuf_stream_count(dataset):
+    rows = get_test_kwargs(dataset)['rows']
+    expected = sum(1 for _ in protobuf_stream_load(rows))
+    actual = loom.util.protobuf_stream_count(rows)
+    assert_equal(actual, expected)
+
+
 def _test_cat(name, paths):
     for key, filename in loom.store.iter_paths(name, paths):
-        if os.path.isdir(filename) and not filename.startswith('test'):
-            for f in os.listdir(filename):
-                _test_cat('{}.{}'.format(name, key), os.path.join(filename, f))
-        else:
-            print('==== {} ===='.format(key))
-            loom.util.cat(filename)
+        _test_cat_path(key, filename, os.path.isdir(filename))
+
+
+def _test_cat_path(key, filename, is_dir):
+    if is_dir and not filename.startswith('test'):
+        with os.scandir(filename) as entries:
+            for entry in entries:
+                _test_cat_path(
+                    '{}.{}'.format(key, entry.name),
+                    entry.path,
+                    entry.is_dir())
+    else:
+        print('==== {} ===='.format(key))
+        loom.util.cat(filename)
+
+
+def _square(x):
+    return x * x
+
+
+def test_thread_map():
+    args = [(i,) for i in range(10)]
+    actual = loom.util.thread_map(_square, args)
+    assert_equal(actual, [i * i for i in range(10)])
+
+
+def test_parallel_map():
+    args = [(i,) for i in range(10)]
+    actual = loom.util.parallel_map(_square, args)
+    assert_equal(actual, [i * i for i in range(10)])
@@ -27,11 +27,16 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import atexit
+import tempfile
 import functools
+import itertools
 from nose.tools import assert_true
+from distributions.io.stream import json_load
 from distributions.io.stream import protobuf_stream_load
 from loom.util import csv_reader
 from loom.schema_pb2 import Row
+import loom.config
 import loom.datasets
 import loom.store
 
@@ -45,6 +50,11 @@ def assert_found(*filenames):
 
 
 def get_test_kwargs(dataset):
+    return dict(_get_test_kwargs(dataset))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_test_kwargs(dataset):
     paths = loom.store.get_paths(dataset, sample_count=2)
     for key, path in loom.store.iter_paths(dataset, paths):
       if not os.path.exists(path):
@@ -62,26 +72,58 @@ def get_test_kwargs(dataset):
     return kwargs
 
 
-def load_rows(filename):
+@functools.lru_cache(maxsize=None)
+def get_seeded_config(seed):
+    '''
+    Dump a query config with the given seed to a file private to this
+    process, so that parallel test workers never share a config path.
+    '''
+    fd, filename = tempfile.mkstemp(suffix='.pb.gz')
+    os.close(fd)
+    atexit.register(os.remove, filename)
+    loom.config.config_dump({'seed': seed}, filename)
+    return filename
+
+
+@functools.lru_cache(maxsize=None)
+def load_json(filename):
+    '''
+    Cached json_load for small read-only fixtures like schema and encoding.
+    '''
+    return json_load(filename)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_rows(filename, mtime_ns, size):
     rows = []
     for string in protobuf_stream_load(filename):
         row = Row()
         row.ParseFromString(string)
         rows.append(row)
-    return rows
+    return tuple(rows)
 
 
-def load_rows_raw(filename):
-    return list(protobuf_stream_load(filename))
+def load_rows(filename):
+    '''
+    Load parsed rows, cached while the file is unchanged.
+    Rows are shared between callers and must not be modified.
+    '''
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    return list(_load_rows(filename, stat.st_mtime_ns, stat.st_size))
 
 
-def load_rows_csv(dirname):
-    filenames = os.listdir(dirname)
-    rows = [None]
-    for filename in filenames:
+def load_rows_csv_head(dirname, count):
+    '''
+    Load the header and first count rows from a directory of csv files.
+    '''
+    header = None
+    rows = []
+    for filename in os.listdir(dirname):
         filename = os.path.join(dirname, filename)
         with csv_reader(filename) as reader:
             header = next(reader)
-            rows += reader
-    rows[0] = header
-    return rows
+            rows += itertools.islice(reader, count - len(rows))
+        if len(rows) >= count:
+            break
+    return header, rows
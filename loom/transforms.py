@@ -26,15 +26,21 @@
 # TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import copy
+import csv
+import io
 import math
 import os
+import functools
 import re
 import datetime
-import dateutil.parser
 from collections import Counter
+from itertools import compress
+from itertools import islice
 from contextlib2 import ExitStack
 from distributions.io.stream import json_dump
 from distributions.io.stream import json_load
+from distributions.io.stream import open_compressed
 import loom.util
 from loom.util import cp_ns
 from loom.util import LOG
@@ -72,11 +78,13 @@ FLUENT_TO_BASIC = {
 
 encode_bool = load_encoder({'model': 'bb'})
 decode_bool = load_decoder({'model': 'bb'})
+FALSE_TOKEN = decode_bool(False)
+TRUE_TOKEN = decode_bool(True)
 
 
 def get_row_dict(header, row):
     '''By convention, empty strings are omitted from the result dict.'''
-    return {key: value for key, value in zip(header, row) if value}
+    return dict(compress(zip(header, row), row))
 
 
 class TransformSequence(object):
@@ -92,19 +100,36 @@ class TransformSequence(object):
     def forward_dict(self, header_out, row_dict):
         for t in self.transforms:
             t.forward(row_dict)
-        return [row_dict.get(key) for key in header_out]
+        return list(map(row_dict.get, header_out))
 
     def forward_row(self, header_in, header_out, row):
         row_dict = get_row_dict(header_in, row)
         for t in self.transforms:
             t.forward(row_dict)
-        return [row_dict.get(key) for key in header_out]
+        return list(map(row_dict.get, header_out))
+
+    def compile_forward_row(self, header_in, header_out):
+        '''
+        Specialize forward_row to fixed headers, binding each transform's
+        forward method once rather than looking it up per row.
+        '''
+        header_in = tuple(header_in)
+        header_out = tuple(header_out)
+        forwards = tuple(t.forward for t in self.transforms)
+
+        def forward_row(row):
+            row_dict = get_row_dict(header_in, row)
+            for forward in forwards:
+                forward(row_dict)
+            return list(map(row_dict.get, header_out))
+
+        return forward_row
 
     def backward_row(self, header_in, header_out, row):
         row_dict = get_row_dict(header_in, row)
         for t in reversed(self.transforms):
             t.backward(row_dict)
-        return [row_dict.get(key) for key in header_out]
+        return list(map(row_dict.get, header_out))
 
 
 def load_transforms(filename):
@@ -175,7 +200,7 @@ class PresenceTransform(object):
 
     def forward(self, row_dict):
         present = self.feature_name in row_dict
-        row_dict[self.present_name] = decode_bool(present)
+        row_dict[self.present_name] = TRUE_TOKEN if present else FALSE_TOKEN
         if present:
             row_dict[self.value_name] = row_dict[self.feature_name]
 
@@ -193,7 +218,13 @@ class SparseRealTransform(object):
         self.feature_name = feature_name
         self.nonzero_name = '{}.nonzero'.format(feature_name)
         self.value_name = '{}.value'.format(feature_name)
-        self.tare_value = str(float(tare_value))
+        self.tare = float(tare_value)
+        self.tare_value = str(self.tare)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'tare' not in state:  # pickled before the numeric tare was stored
+            self.tare = float(self.tare_value)
 
     def get_schema(self):
         return {self.nonzero_name: 'bb', self.value_name: 'nich'}
@@ -207,8 +238,9 @@ class SparseRealTransform(object):
         feature_name = self.feature_name
         if feature_name in row_dict:
             value = float(row_dict[feature_name])
-            nonzero = (value != self.tare_value)
-            row_dict[self.nonzero_name] = decode_bool(nonzero)
+            nonzero = (value != self.tare)
+            token = TRUE_TOKEN if nonzero else FALSE_TOKEN
+            row_dict[self.nonzero_name] = token
             if nonzero:
                 row_dict[self.value_name] = value
 
@@ -226,11 +258,15 @@ class SparseRealTransform(object):
 
 MIN_WORD_FREQ = 0.01
 
-split_text = re.compile('\W+').split
+find_words = re.compile(r'\w+').findall
+find_ascii_words = re.compile(r'\w+', re.ASCII).findall
 
 
 def get_word_set(text):
-    return frozenset(s for s in split_text(text.lower()) if s)
+    text = text.lower()
+    # for ascii text the ascii pattern finds the same words, faster
+    find = find_ascii_words if text.isascii() else find_words
+    return frozenset(find(text))
 
 
 class TextTransformBuilder(object):
@@ -248,6 +284,10 @@ class TextTransformBuilder(object):
         text = row_dict.get(self.feature_name, '')
         self.counts.update(get_word_set(text))
 
+    def __iadd__(self, other):
+        self.counts.update(other.counts)
+        return self
+
     def build(self):
         counts = self.counts.most_common()
         max_count = counts[0][1]
@@ -264,6 +304,27 @@ class TextTransform(object):
             for word in words
         ]
         self.allow_empty = allow_empty
+        self._init_lookups()
+
+    def _init_lookups(self):
+        self._word_to_feature = {
+            word: feature_name
+            for feature_name, word in self.features
+        }
+        self._zeros = {feature_name: '0' for feature_name, _ in self.features}
+
+    def __getstate__(self):
+        return (self.feature_name, self.features, self.allow_empty)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):  # pickled before lookups were cached
+            state = (
+                state['feature_name'],
+                state['features'],
+                state['allow_empty'],
+            )
+        self.feature_name, self.features, self.allow_empty = state
+        self._init_lookups()
 
     def get_schema(self):
         return {feature_name: 'bb' for feature_name, _ in self.features}
@@ -276,9 +337,12 @@ class TextTransform(object):
     def forward(self, row_dict):
         if self.feature_name in row_dict or self.allow_empty:
             text = row_dict.get(self.feature_name, '')
-            word_set = get_word_set(text)
-            for feature_name, word in self.features:
-                row_dict[feature_name] = '1' if word in word_set else '0'
+            row_dict.update(self._zeros)
+            word_to_feature = self._word_to_feature
+            for word in get_word_set(text):
+                feature_name = word_to_feature.get(word)
+                if feature_name is not None:
+                    row_dict[feature_name] = '1'
 
     def backward(self, row_dict):
         row_dict[self.feature_name] = ' '.join([
@@ -291,7 +355,21 @@ class TextTransform(object):
 # ----------------------------------------------------------------------------
 # date transform
 
-EPOCH = dateutil.parser.parse('2014-03-31')  # arbitrary (Loom's birthday)
+EPOCH = datetime.datetime(2014, 3, 31)  # arbitrary (Loom's birthday)
+DATE_CACHE_SIZE = 1 << 15
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(text):
+    '''
+    Parse a date string, trying the fast iso format before dateutil.
+    Date columns repeat heavily, so results are cached.
+    '''
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        import dateutil.parser  # slow to import, and rarely needed
+        return dateutil.parser.parse(text)
 
 
 def days_between(start, end):
@@ -334,7 +412,7 @@ class DateTransform(object):
 
     def forward(self, row_dict):
         if self.feature_name in row_dict:
-            date = dateutil.parser.parse(row_dict[self.feature_name])
+            date = parse_date(row_dict[self.feature_name])
 
             abs_names = self.abs_names
             row_dict[abs_names['absolute']] = days_between(EPOCH, date)
@@ -345,7 +423,7 @@ class DateTransform(object):
 
             for relative, rel_name in self.rel_names.items():
                 if relative in row_dict:
-                    other_date = dateutil.parser.parse(row_dict[relative])
+                    other_date = parse_date(row_dict[relative])
                     row_dict[rel_name] = days_between(other_date, date)
 
     def backward(self, row_dict):
@@ -374,20 +452,31 @@ def load_schema(schema_csv):
     return fluent_schema
 
 
+def _build_transforms_file(filename, transforms, builders):
+    builders = copy.deepcopy(builders)
+    with loom.util.csv_reader(filename) as reader:
+        header = next(reader)
+        for row in reader:
+            row_dict = get_row_dict(header, row)
+            for transform in transforms:
+                transform.forward(row_dict)
+            for builder in builders:
+                builder.add_row(row_dict)
+    return builders
+
+
 def build_transforms(rows_in, transforms, builders):
     if os.path.isdir(rows_in):
         filenames = [os.path.join(rows_in, f) for f in os.listdir(rows_in)]
     else:
         filenames = [rows_in]
-    for filename in filenames:
-        with loom.util.csv_reader(filename) as reader:
-            header = next(reader)
-            for row in reader:
-                row_dict = get_row_dict(header, row)
-                for transform in transforms:
-                    transform.forward(row_dict)
-                for builder in builders:
-                    builder.add_row(row_dict)
+    partial_builders = parallel_map(_build_transforms_file, [
+        (filename, transforms, builders) for filename in filenames
+    ])
+    for other_builders in partial_builders:
+        for builder, other in zip(builders, other_builders):
+            assert builder.feature_name == other.feature_name
+            builder += other
     return [builder.build() for builder in builders]
 
 
@@ -451,17 +540,28 @@ def make_transforms(schema_in, rows_in, schema_out, transforms_out):
 # ----------------------------------------------------------------------------
 # applying transforms
 
+WRITE_CHUNK_ROWS = 1 << 12
+
 
 def _transform_rows(transform, transformed_header, rows_in, rows_out):
     with ExitStack() as stack:
         with_ = stack.enter_context
         reader = with_(loom.util.csv_reader(rows_in))
-        writer = with_(loom.util.csv_writer(rows_out))
+        f = with_(open_compressed(rows_out, 'wt'))
         header = next(reader)
+        forward_row = transform.compile_forward_row(header, transformed_header)
+        rows = map(forward_row, reader)
+        # format chunks of rows in memory so the compressor sees big writes
+        buf = io.StringIO()
+        writer = csv.writer(buf)
         writer.writerow(transformed_header)
-        for row in reader:
-            row = transform.forward_row(header, transformed_header, row)
-            writer.writerow(row)
+        while True:
+            writer.writerows(islice(rows, WRITE_CHUNK_ROWS))
+            if not buf.tell():
+                break
+            f.write(buf.getvalue())
+            buf.seek(0)
+            buf.truncate()
 
 
 @loom.documented.transform(
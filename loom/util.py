@@ -26,9 +26,11 @@
 # TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import io
 import itertools
 import os
 import pickle
+import struct
 import sys
 import csv
 import shutil
@@ -36,15 +38,15 @@ import tempfile
 import traceback
 import contextlib
 import multiprocessing
-import simplejson as json
-from google.protobuf.descriptor import FieldDescriptor
+from concurrent.futures import ThreadPoolExecutor
+import json
 from distributions.io.stream import open_compressed
 from distributions.io.stream import json_load
 from distributions.io.stream import protobuf_stream_load
-import loom.schema_pb2
 import parsable
 parsable = parsable.Parsable()
 
+STREAM_BUFFER_SIZE = 1 << 17
 THREADS = int(os.environ.get('LOOM_THREADS', multiprocessing.cpu_count()))
 VERBOSITY = int(os.environ.get('LOOM_VERBOSITY', 1))
 
@@ -59,7 +61,10 @@ class KnownBug(LoomError):
 
 def fixme(name, message):
     message = 'FIXME({}) {}'.format(name, message)
-    if 'nose' in sys.modules:
+    if 'pytest' in sys.modules:
+        import pytest
+        return pytest.skip.Exception(message)
+    elif 'nose' in sys.modules:
         import nose
         return nose.SkipTest(message)
     else:
@@ -159,11 +164,31 @@ def parallel_map(fun, args):
         LOG('Running {} in this thread'.format(fun.__name__))
         return list(itertools.starmap(print_trace, fun_args))
     else:
-        LOG('Running {} in {:d} threads'.format(fun.__name__, THREADS))
-        # FIXME: Multiprocessing hangs.
-        # pool = multiprocessing.Pool(THREADS)
-        # return pool.starmap(print_trace, fun_args, chunksize=1)
+        processes = min(THREADS, len(args))
+        LOG('Running {} in {:d} processes'.format(fun.__name__, processes))
+        # spawn rather than fork, since forking a process with live threads
+        # (e.g. query server readers) can deadlock the children
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes) as pool:
+            return pool.starmap(print_trace, fun_args, chunksize=1)
+
+
+def thread_map(fun, args):
+    '''
+    Like parallel_map, but for tasks that spend their time waiting on
+    subprocesses, where threads suffice and nothing needs pickling.
+    '''
+    if not isinstance(args, list):
+        args = list(args)
+    fun_args = [(fun, arg) for arg in args]
+    if THREADS == 1 or len(args) < 2:
+        LOG('Running {} in this thread'.format(fun.__name__))
         return list(itertools.starmap(print_trace, fun_args))
+    else:
+        workers = min(THREADS, len(args))
+        LOG('Running {} in {:d} threads'.format(fun.__name__, workers))
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(print_trace, [fun] * len(args), args))
 
 
 @contextlib.contextmanager
@@ -180,7 +205,7 @@ def csv_writer(filename):
 
 def pickle_dump(data, filename):
     with open_compressed(filename, 'wb') as f:
-        pickle.dump(data, f)
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def pickle_load(filename):
@@ -188,14 +213,32 @@ def pickle_load(filename):
         return pickle.load(f)
 
 
+def protobuf_stream_count(filename):
+    '''
+    Count messages in a protobuf stream by reading only their size prefixes.
+    '''
+    count = 0
+    with open_compressed(filename, 'rb') as raw:
+        f = io.BufferedReader(raw, buffer_size=STREAM_BUFFER_SIZE)
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            size, = struct.unpack('<I', header)
+            f.seek(size, io.SEEK_CUR)
+            count += 1
+    return count
+
+
 def protobuf_to_dict(message):
+    from google.protobuf.descriptor import FieldDescriptor
     assert message.IsInitialized()
     raw = {}
     for field in message.DESCRIPTOR.fields:
         value = getattr(message, field.name)
         if field.label == FieldDescriptor.LABEL_REPEATED:
             if field.type == FieldDescriptor.TYPE_MESSAGE:
-                value = map(protobuf_to_dict, value)
+                value = list(map(protobuf_to_dict, value))
             else:
                 value = list(value)
             if len(value) == 0:
@@ -265,6 +308,7 @@ def get_message(filename, message_type='guess'):
         except KeyError:
             raise LoomError(
                 'Cannot guess message type for {}'.format(filename))
+    import loom.schema_pb2  # deferred to keep loom.util cheap to import
     Message = loom.schema_pb2
     for attr in message_type.split('.'):
         Message = getattr(Message, attr)
@@ -297,9 +341,14 @@ def pretty_print(filename, message_type='guess'):
         data = pickle_load(filename)
         print(repr(data))
     else:
-        with open_compressed(filename) as f:
-            for line in f:
-                print(line)
+        sys.stdout.flush()
+        stdout = getattr(sys.stdout, 'buffer', None)
+        with open_compressed(filename, 'rb') as f:
+            if stdout is None:  # text-only stream, e.g. StringIO or Jupyter
+                sys.stdout.write(f.read().decode())
+            else:
+                shutil.copyfileobj(f, stdout, STREAM_BUFFER_SIZE)
+                stdout.flush()
 
 
 @parsable.command
@@ -40,7 +40,7 @@ SYMBOLS = {
 extensions = sum(SYMBOLS.values(), [])
 SYMBOL_OF = {
     extension: symbol
-    for symbol, extensions in SYMBOLS.iteritems()
+    for symbol, extensions in SYMBOLS.items()
     for extension in extensions
 }
 